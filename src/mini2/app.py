@@ -1,16 +1,109 @@
-import requests
 import asyncio
+import httpx
+import orjson
+import re
+import sqlite3
+import time
+import warnings
+import weakref
 from langchain.tools import tool
 import os
+from contextlib import closing
+from functools import cached_property, lru_cache
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
 from dotenv import load_dotenv
-from typing import TypedDict, List
+from typing import AsyncIterator, TypedDict, List, Optional
 from langchain_openai import ChatOpenAI
+from langchain_community.cache import SQLiteCache
 from langchain_community.tools import DuckDuckGoSearchRun
+from langchain_core.prompts import ChatPromptTemplate
 from langgraph.graph import StateGraph, END
+from pydantic import BaseModel, Field
 from typing import Dict
 
 load_dotenv()
 
+CACHE_DIR = Path(os.getenv("MINI2_CACHE_DIR", Path.home() / ".cache" / "mini2"))
+
+# One forecast entry per day for each city; the 5-day forecast is the same whatever `days` is requested
+_WEATHER_CACHE = TTLCache(maxsize=256, ttl=1800)
+# Search results per (city, category), so re-searches and repeat requests skip DuckDuckGo
+_SEARCH_CACHE = TTLCache(maxsize=512, ttl=1800)
+
+# Number of most frequently planned cities whose forecasts are fetched before they are asked for
+PREWARM_CITIES = 10
+
+# One HTTP/2 client for OpenWeatherMap and OpenAI, so both reuse pooled connections
+_HTTP_CLIENT: Optional["_LoopLocalClient"] = None
+
+# One-word INDOOR/OUTDOOR/BOTH answers only need a few tokens
+DECISION_LLM_KWARGS = {"max_tokens": 5, "stop": ["\n"]}
+
+# Upper bound on simultaneous DuckDuckGo searches, to stay clear of rate limits
+MAX_CONCURRENT_SEARCHES = 5
+
+# ddgs has no async client, so searches run on their own threads instead of the loop's default executor
+_SEARCH_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_SEARCHES, thread_name_prefix="ddg-search")
+_SEARCH_TOOL = DuckDuckGoSearchRun()
+# What the search tool returns for an empty (often rate-limited) search instead of raising
+NO_SEARCH_RESULTS = "No good DuckDuckGo Search Result was found"
+
+# Multi-word capitalised phrases ("Vatican Museums", "Musée d'Orsay") are taken as place names;
+# words are matched as Unicode letters with an optional elided article such as d' or l'
+_PLACE_WORD_RE = re.compile(r"(?:[^\W\d_]['’])?([^\W\d_]+)")
+_PLACE_GAP_RE = re.compile(r"[\s-]+")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+# Search results are cut to this many characters before they go into the itinerary prompt
+MAX_RESULT_CHARS = 800
+
+PARSE_TEMPLATE = 'Extract the city, number of days and interests from this travel request: "{user_request}"'
+
+DECIDE_TEMPLATE = """Based on this weather forecast: {weather_data}
+
+Should we prioritize INDOOR, OUTDOOR, or BOTH activities?
+Consider rain, extreme temperatures, etc.
+Answer with only one word: INDOOR, OUTDOOR, or BOTH"""
+
+GENERATE_TEMPLATE = """Create a {days}-day travel itinerary for {city}.
+
+Weather: {weather_data}
+Activities: {activities}
+
+Create a detailed, practical itinerary that:
+- Balances activities with rest time
+- Includes specific timing and logistics
+- Suggests backup options for bad weather
+- Uses actual place names from the activities data provided
+
+
+Return ONLY in this format:
+# {days}-Day Itinerary for {city}
+
+## Day 1: [Weather]
+- **Morning**: [Activity with specific place name]
+- **Lunch**: [Restaurant name and cuisine type]
+- **Afternoon**: [Activity with specific place name]
+- **Evening**: [Activity/Dinner with specific place name]
+- **Weather**: [Expected conditions and recommendations]
+- **Backup Plan**: [Alternative if weather is bad]
+
+## Day 2: [Weather]
+[Same structure...]
+
+[Repeat for all {days} days]
+"""
+
+
+class ParsedRequest(BaseModel):
+    """Trip details extracted from the user request."""
+    city: str = Field(default="Unknown", description="Destination city")
+    days: int = Field(default=5, ge=1, description="Number of days of the trip")
+    interests: str = Field(default="sightseeing", description="Comma-separated interests")
+
+
 class GraphState(TypedDict):
     user_request: str      # Input: "I want to go to Athens for 5 days"
     city: str              # Parsed: "Athens"
@@ -19,12 +112,57 @@ class GraphState(TypedDict):
     weather_data: str     # From weather tool
     activity_preference: str  # Decision: "INDOOR", "OUTDOOR", or "BOTH"
     activities: List[str]  # From activities tool
+    searched_preference: str  # Preference the current activities were searched with
     final_itinerary: str   # From LLM generation
-    search_iterations: int  # Track number of search loops
+
+
+class _LoopLocalClient(httpx.AsyncClient):
+    """HTTP client that sends through a separate pooled client for each event loop."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._client_kwargs = kwargs
+        # Pooled connections are bound to the loop that opened them and fail once it is closed
+        self._loop_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    def loop_client(self) -> httpx.AsyncClient:
+        """Return the plain client for the running loop, which keeps httpx's proxy handling."""
+        loop = asyncio.get_running_loop()
+        client = self._loop_clients.get(loop)
+        if client is None:
+            client = self._loop_clients[loop] = httpx.AsyncClient(**self._client_kwargs)
+        return client
+
+    async def send(self, request: httpx.Request, **kwargs) -> httpx.Response:
+        return await self.loop_client().send(request, **kwargs)
+
+    async def aclose_loop_client(self) -> None:
+        """Close the running loop's client; later requests on the loop open a new one."""
+        client = self._loop_clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+
+def _get_http_client() -> httpx.AsyncClient:
+    """Return the shared HTTP client, creating it on first use."""
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is None:
+        _HTTP_CLIENT = _LoopLocalClient(
+            http2=True,
+            timeout=30,
+            limits=httpx.Limits(max_keepalive_connections=20)
+        )
+    return _HTTP_CLIENT
+
+
+async def close_http_client() -> None:
+    """Close the connections pooled for the running loop; the shared client stays usable."""
+    if _HTTP_CLIENT is not None:
+        await _HTTP_CLIENT.aclose_loop_client()
 
 
 @tool
-def get_weather_forecast(city: str, days: int) -> str:
+async def get_weather_forecast(city: str, days: int) -> str:
     """Get weather forecast for a city using OpenWeatherMap API."""
     
     api_key = os.getenv("OPENWEATHERMAP_API_KEY")
@@ -32,24 +170,22 @@ def get_weather_forecast(city: str, days: int) -> str:
         return "Error: OPENWEATHERMAP_API_KEY not set"
     
     url = f"http://api.openweathermap.org/data/2.5/forecast?q={city}&appid={api_key}&units=metric"
+    cache_key = city.strip().lower()
     
     try:
-        response = requests.get(url)
-        response.raise_for_status()
-        data = response.json()
-        
-        forecasts = []
-        max_days = min(days, 5)  # API only provides 5 days
+        daily_forecasts = _WEATHER_CACHE.get(cache_key)
+        if daily_forecasts is None:
+            response = await _get_http_client().get(url)
+            response.raise_for_status()
+            data = orjson.loads(response.content)
+            # API returns 3-hour intervals (8 data points per day), so every 8th entry is the same time each day
+            daily_forecasts = data['list'][::8]
+            _WEATHER_CACHE[cache_key] = daily_forecasts
 
-        for i in range(max_days):
-            # API returns 3-hour intervals (8 data points per day), so i * 8 jumps to same time each day
-            if i * 8 < len(data['list']):
-                forecast = data['list'][i * 8]
-                weather = forecast['weather'][0]['main']
-                temp = forecast['main']['temp']
-                forecasts.append(f"Day {i+1}: {weather}, {temp}°C")
-            else:
-                forecasts.append(f"Day {i+1}: Could not get forecast")
+        max_days = min(days, 5)  # API only provides 5 days
+        daily = daily_forecasts[:max_days]
+        forecasts = [f"Day {i+1}: {f['weather'][0]['main']}, {f['main']['temp']}°C" for i, f in enumerate(daily)]
+        forecasts += [f"Day {i+1}: Could not get forecast" for i in range(len(daily), max_days)]
         
         return " | ".join(forecasts)
     
@@ -57,115 +193,206 @@ def get_weather_forecast(city: str, days: int) -> str:
         return f"Error fetching weather: {str(e)}"
 
 
+def _open_city_log() -> sqlite3.Connection:
+    """Open the log of planned cities, creating it if needed."""
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(CACHE_DIR / "cities.sqlite")
+    conn.execute("CREATE TABLE IF NOT EXISTS cities (city TEXT PRIMARY KEY, last_used REAL, count INTEGER)")
+    return conn
+
+
+def _record_city(city: str) -> None:
+    """Count a trip to `city` in the city log."""
+    try:
+        with closing(_open_city_log()) as conn, conn:
+            conn.execute(
+                "INSERT INTO cities VALUES (?, ?, 1) "
+                "ON CONFLICT(city) DO UPDATE SET last_used = excluded.last_used, count = count + 1",
+                (city.strip().lower(), time.time())
+            )
+    except (sqlite3.Error, OSError) as e:
+        print(f"Could not record city: {e}")
+
+
+def _top_cities(limit: int) -> List[str]:
+    """Return the most frequently planned cities, most recent first on ties."""
+    with closing(_open_city_log()) as conn:
+        rows = conn.execute(
+            "SELECT city FROM cities ORDER BY count DESC, last_used DESC LIMIT ?", (limit,)
+        ).fetchall()
+    return [city for (city,) in rows]
+
+
+def _count_place_names(text: str) -> int:
+    """Count the distinct place names mentioned in a search result."""
+    names, run, run_end = set(), [], 0
+    for match in _PLACE_WORD_RE.finditer(text):
+        word = match.group(1)
+        if not (word[0].isupper() and word[1:].islower()):
+            continue
+        if run and not _PLACE_GAP_RE.fullmatch(text, run_end, match.start()):
+            if len(run) > 1:
+                names.add(" ".join(run))
+            run = []
+        run.append(match.group())
+        run_end = match.end()
+    if len(run) > 1:
+        names.add(" ".join(run))
+    return len(names)
+
+
+def _is_failed_search(text: str) -> bool:
+    """Whether a search result is an error or the tool's empty-result message."""
+    return text.startswith("Error searching for") or text == NO_SEARCH_RESULTS
+
+
+def _compact_result(text: str) -> str:
+    """Collapse whitespace and truncate a search result to keep prompts short."""
+    return _WHITESPACE_RE.sub(" ", text).strip()[:MAX_RESULT_CHARS]
+
+
 @tool
 async def find_points_of_interest(city: str, category: str) -> str:
     """Find attractions in a city by category using DuckDuckGo search."""
 
-    search = DuckDuckGoSearchRun()
+    cache_key = (city.strip().lower(), category.strip().lower())
+    if cache_key in _SEARCH_CACHE:
+        return _SEARCH_CACHE[cache_key]
 
     query = f"best {category} in {city}"
 
     try:
-        loop = asyncio.get_event_loop()
-        results = await loop.run_in_executor(None, search.run, query)
+        loop = asyncio.get_running_loop()
+        results = await loop.run_in_executor(_SEARCH_EXECUTOR, _SEARCH_TOOL.run, query)
+        # Empty results are retried on the next request rather than served for the cache's lifetime
+        if results != NO_SEARCH_RESULTS:
+            _SEARCH_CACHE[cache_key] = results
         return results
     except Exception as e:
         return f"Error searching for {category}: {str(e)}"
 
 
+@lru_cache(maxsize=None)
+def _get_llm(model: str, api_key: Optional[str], base_url: Optional[str]) -> ChatOpenAI:
+    """Return the ChatOpenAI client shared by every agent with the same settings."""
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    return ChatOpenAI(
+        model=model,
+        api_key=api_key,
+        base_url=base_url,
+        temperature=0,
+        http_async_client=_get_http_client(),
+        # temperature=0 makes responses reproducible, so identical prompts are answered from disk
+        cache=SQLiteCache(database_path=str(CACHE_DIR / "llm_cache.db"))
+    )
+
+
 class TravelAgent:
     """AI-powered travel assistant that generates personalized itineraries."""
 
-    def __init__(self, max_search_iterations: int = 2):
+    def __init__(self, max_search_iterations: Optional[int] = None):
         """Initialize the TravelAgent with LLM and workflow configuration."""
-        self.llm = ChatOpenAI(
-            model=os.getenv("OPENAI_MODEL_NAME", "gpt-4-turbo"),
-            api_key=os.getenv("OPENAI_API_KEY"),
-            base_url=os.getenv("OPENAI_ENDPOINT"),
-            temperature=0
+        if max_search_iterations is not None:
+            warnings.warn(
+                "max_search_iterations is ignored: activities are searched once with ranked queries",
+                DeprecationWarning,
+                stacklevel=2
+            )
+        self.llm = _get_llm(
+            os.getenv("OPENAI_MODEL_NAME", "gpt-4-turbo"),
+            os.getenv("OPENAI_API_KEY"),
+            os.getenv("OPENAI_ENDPOINT")
         )
-        self.max_search_iterations = max_search_iterations
-        self.app = self._build_graph()
+        self._parse_tmpl = ChatPromptTemplate.from_template(PARSE_TEMPLATE)
+        # Function calling returns the fields directly instead of labelled text to split
+        self._parse_llm = self.llm.with_structured_output(ParsedRequest, method="function_calling")
+        self._decide_tmpl = ChatPromptTemplate.from_template(DECIDE_TEMPLATE)
+        self._gen_tmpl = ChatPromptTemplate.from_template(GENERATE_TEMPLATE)
+        self._prewarm_task: Optional[asyncio.Task] = None
+        # In-flight forecast fetches by city, so prewarming and weather_node never fetch a city twice
+        self._forecast_fetches: Dict[str, asyncio.Task] = {}
+
+    @cached_property
+    def app(self):
+        """Compiled workflow, built on first use."""
+        return self._build_graph()
 
     def _build_graph(self):
         """Build the LangGraph workflow."""
         workflow = StateGraph(GraphState)
 
         workflow.add_node("parse", self.parse_request_node)
-        workflow.add_node("weather", self.weather_node)
+        workflow.add_node("parallel_fetch", self.parallel_fetch_node)
         workflow.add_node("decide", self.decide_activity_type_node)
         workflow.add_node("activities", self.activities_node)
         workflow.add_node("generate", self.generate_itinerary_node)
 
         workflow.set_entry_point("parse")
 
-        # Flow: parse → weather → decide → activities → (check quality) → loop or generate
-        workflow.add_edge("parse", "weather")
-        workflow.add_edge("weather", "decide")
-        workflow.add_edge("decide", "activities")
+        # Flow: parse → (weather + activities) → decide → re-search if needed → generate
+        workflow.add_edge("parse", "parallel_fetch")
+        workflow.add_edge("parallel_fetch", "decide")
 
-        # Activities has conditional routing (loop or continue)
+        # Decide only re-runs the search if the weather preference changes the queries
         workflow.add_conditional_edges(
-            "activities",
-            self.check_activity_quality,
+            "decide",
+            self.route_after_decide,
             {
-                "activities": "activities",  # Loop back for refinement
-                "generate": "generate"       # Continue to final generation
+                "activities": "activities",
+                "generate": "generate"
             }
         )
 
+        workflow.add_edge("activities", "generate")
         workflow.add_edge("generate", END)
 
         return workflow.compile()
 
-    def parse_request_node(self, state: GraphState) -> Dict:
+    async def parse_request_node(self, state: GraphState) -> Dict:
         """Extract city, days, and interests from user request."""
         print("Parsing request...")
-        prompt = f"""Extract the following from this travel request: "{state['user_request']}"
-        Return ONLY in this format:
-        City: <city name>
-        Days: <number>
-        Interests: <comma-separated interests>"""
-
-        response = self.llm.invoke(prompt)
-        print(f"LLM response: {response.content}")
-        # Parse the LLM response
-        lines = [line.strip() for line in response.content.split('\n') if line.strip()]
-
-        parsed_data = {}
-        for line in lines:
-            if ': ' in line:
-                key, value = line.split(': ', 1)
-                parsed_data[key.lower()] = value
-
-        result = {
-            "city": parsed_data.get("city", "Unknown"),
-            "days": int(parsed_data.get("days", 5)),
-            "interests": parsed_data.get("interests", "sightseeing")
-        }
+        prompt = self._parse_tmpl.format_messages(user_request=state["user_request"])
+
+        try:
+            parsed = await self._parse_llm.ainvoke(prompt)
+        except ValueError as e:
+            # Malformed or invalid tool arguments, e.g. days=0
+            print(f"Could not parse request: {e}")
+            parsed = None
+
+        # A reply without a tool call parses to None; both cases fall back to the defaults
+        result = (parsed or ParsedRequest()).model_dump()
         print(f"Parsed: {result}")
         return result
 
-    def weather_node(self, state: GraphState) -> Dict:
+    async def weather_node(self, state: GraphState) -> Dict:
         """Fetch weather data."""
         print(f"Fetching weather for {state['city']}...")
-        weather = get_weather_forecast.invoke({
-            "city": state["city"],
-            "days": state["days"]
-        })
+        pending = self._forecast_fetches.get(state["city"].strip().lower())
+        if pending is not None:
+            # Prewarming is already fetching this city; once it lands the forecast comes from the cache
+            await asyncio.wait([pending])
+        weather = await self._fetch_forecast(state["city"], state["days"])
         print(f"Weather: {weather}")
+        # Remember the city so its forecast is pre-fetched on later runs, unless it has no forecast
+        if not weather.startswith("Error"):
+            await asyncio.to_thread(_record_city, state["city"])
         return {"weather_data": weather}
 
-    def decide_activity_type_node(self, state: GraphState) -> Dict:
+    async def parallel_fetch_node(self, state: GraphState) -> Dict:
+        """Fetch weather and a speculative unmodified activities search concurrently."""
+        weather, activities = await asyncio.gather(
+            self.weather_node(state),
+            self.activities_node({**state, "activity_preference": "BOTH"})
+        )
+        return {**weather, **activities}
+
+    async def decide_activity_type_node(self, state: GraphState) -> Dict:
         """Decide indoor/outdoor activities based on weather."""
         print("Deciding activity type based on weather...")
-        prompt = f"""Based on this weather forecast: {state['weather_data']}
+        prompt = self._decide_tmpl.format_messages(weather_data=state["weather_data"])
 
-        Should we prioritize INDOOR, OUTDOOR, or BOTH activities?
-        Consider rain, extreme temperatures, etc.
-        Answer with only one word: INDOOR, OUTDOOR, or BOTH"""
-
-        response = self.llm.invoke(prompt)
+        response = await self.llm.ainvoke(prompt, **DECISION_LLM_KWARGS)
         decision = response.content.strip().upper()
 
         # Ensure valid response
@@ -178,10 +405,10 @@ class TravelAgent:
     async def activities_node(self, state: GraphState) -> Dict:
         """Fetch activities based on interests and weather preference."""
         preference = state.get("activity_preference", "BOTH")
-        current_iteration = state.get("search_iterations", 0) + 1
 
-        print(f"Fetching activities (iteration {current_iteration}) for {state['interests']} (preference: {preference})...")
-        interests_list = [i.strip() for i in state["interests"].split(',')]
+        print(f"Fetching activities for {state['interests']} (preference: {preference})...")
+        # Normalise and drop duplicate interests so each category is searched once
+        interests_list = list(dict.fromkeys(i.strip().lower() for i in state["interests"].split(',') if i.strip()))
 
         # Modify search based on weather preference
         modifier = ""
@@ -190,109 +417,126 @@ class TravelAgent:
         elif preference == "OUTDOOR":
             modifier = "outdoor "
 
-        search_tasks = []
-        for interest in interests_list:
-            search_category = f"{modifier}{interest}" if modifier else interest
-            print(f"Searching for {search_category}...")
-            task = find_points_of_interest.ainvoke({
-                "city": state["city"],
-                "category": search_category
-            })
-            search_tasks.append((interest, task))
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_SEARCHES)
 
-        # Execute all searches in parallel
-        results = await asyncio.gather(*[task for _, task in search_tasks])
+        async def search(category: str) -> str:
+            async with semaphore:
+                return await find_points_of_interest.ainvoke({
+                    "city": state["city"],
+                    "category": category
+                })
 
-        # Combine interests with results
-        activities = [f"{interest.title()}: {result}" for (interest, _), result in zip(search_tasks, results)]
+        # One coroutine per interest, in the same order as interests_list
+        searches = []
+        for interest in interests_list:
+            # With a modifier, also search the plain interest in case the qualified query is too vague
+            search_categories = [f"{modifier}{interest}", interest] if modifier else [interest]
+            for search_category in search_categories:
+                print(f"Searching for {search_category}...")
+            searches.append(asyncio.gather(*[search(c) for c in search_categories]))
+
+        # Execute all searches in parallel, at most MAX_CONCURRENT_SEARCHES at a time
+        results = await asyncio.gather(*searches)
+
+        # Keep the result naming the most places per interest; ties keep the weather-qualified one.
+        # Failed searches are never ranked, and if every query failed the plain one is reported
+        activities = []
+        for interest, candidates in zip(interests_list, results):
+            usable = [c for c in candidates if not _is_failed_search(c)] or candidates[-1:]
+            activities.append(f"{interest.title()}: {_compact_result(max(usable, key=_count_place_names))}")
 
         print("Activities done")
-        return {"activities": activities, "search_iterations": current_iteration}
-
-    def check_activity_quality(self, state: GraphState) -> str:
-        """Check if activities are specific enough."""
-        current_iteration = state.get("search_iterations", 0)
-        max_iterations = self.max_search_iterations
+        return {"activities": activities, "searched_preference": preference}
 
-        print("\n=== CHECKING ACTIVITY QUALITY ===")
-        print(f"Current iteration: {current_iteration}/{max_iterations}")
-        print(f"Activities to evaluate: {state['activities']}")
+    def route_after_decide(self, state: GraphState) -> str:
+        """Reuse the speculative activities unless the weather preference changes the search."""
+        if state["activity_preference"] != state.get("searched_preference"):
+            print("→ Weather preference differs from the speculative search, searching again...\n")
+            return "activities"
 
-        if current_iteration >= max_iterations:
-            print(f"→ Max iterations ({max_iterations}) reached, proceeding with current results...\n")
-            return "generate"
+        print("→ Speculative activities match the weather preference, proceeding to itinerary generation...\n")
+        return "generate"
 
-        prompt = f"""Review these activities for {state['city']}:
-        {' '.join(state['activities'])}
-
-        Do these include SOME specific venue/place names? Be lenient - if you can identify at least a few actual names (like restaurants, bars, temples, trails), answer SUFFICIENT.
-        If it's all generic descriptions with NO specific names, answer NEED_MORE.
-        Answer only: SUFFICIENT or NEED_MORE"""
-
-        response = self.llm.invoke(prompt)
-        decision = response.content.strip().upper()
-
-        print(f"LLM Response: '{response.content}'")
-        print(f"Decision: {decision}")
-
-        if "NEED_MORE" in decision:
-            print("→ Activities need refinement, searching again...\n")
-            return "activities"  # Loop back
-
-        print("→ Activities are sufficient, proceeding to itinerary generation...\n")
-        return "generate"  # Move forward
-
-    def generate_itinerary_node(self, state: GraphState) -> Dict:
+    async def generate_itinerary_node(self, state: GraphState) -> Dict:
         """Generate final itinerary using LLM."""
         print("Generating itinerary...")
 
-        prompt = f"""Create a {state['days']}-day travel itinerary for {state['city']}.
-
-        Weather: {state['weather_data']}
-        Activities: {' '.join(state['activities'])}
-
-        Create a detailed, practical itinerary that:
-        - Balances activities with rest time
-        - Includes specific timing and logistics
-        - Suggests backup options for bad weather
-        - Uses actual place names from the activities data provided
-
-
-        Return ONLY in this format:
-        # {state['days']}-Day Itinerary for {state['city']}
-
-        ## Day 1: [Weather]
-        - **Morning**: [Activity with specific place name]
-        - **Lunch**: [Restaurant name and cuisine type]
-        - **Afternoon**: [Activity with specific place name]
-        - **Evening**: [Activity/Dinner with specific place name]
-        - **Weather**: [Expected conditions and recommendations]
-        - **Backup Plan**: [Alternative if weather is bad]
-
-        ## Day 2: [Weather]
-        [Same structure...]
-
-        [Repeat for all {state['days']} days]
-
-        """
+        prompt = self._gen_tmpl.format_messages(
+            days=state["days"],
+            city=state["city"],
+            weather_data=state["weather_data"],
+            activities=" ".join(state["activities"])
+        )
 
-        response = self.llm.invoke(prompt)
+        response = await self.llm.ainvoke(prompt)
         print("Itinerary complete!")
         return {"final_itinerary": response.content}
 
+    def _fetch_forecast(self, city: str, days: int) -> asyncio.Task:
+        """Start a forecast fetch that other fetches for the same city can wait on."""
+        key = city.strip().lower()
+        task = asyncio.create_task(get_weather_forecast.ainvoke({"city": city, "days": days}))
+        self._forecast_fetches[key] = task
+
+        def forget(finished: asyncio.Task) -> None:
+            if self._forecast_fetches.get(key) is finished:
+                del self._forecast_fetches[key]
+
+        task.add_done_callback(forget)
+        return task
+
+    async def _prewarm(self) -> None:
+        """Fill the weather cache for the most frequently planned cities."""
+        try:
+            cities = await asyncio.to_thread(_top_cities, PREWARM_CITIES)
+            # Skip cities that are already cached or being fetched for a trip
+            cities = [c for c in cities if c not in _WEATHER_CACHE and c not in self._forecast_fetches]
+            # The cache holds the full 5-day forecast per city, whatever `days` a later request uses
+            await asyncio.gather(*[self._fetch_forecast(city, 5) for city in cities])
+        except Exception as e:
+            print(f"Weather prewarm failed: {e}")
+
+    def start_prewarm(self) -> None:
+        """Start pre-fetching popular forecasts in the background.
+
+        The forecast cache lives in memory, so this only pays off when the agent plans
+        several trips in one process; a single CLI run would discard the forecasts.
+        """
+        if self._prewarm_task is None:
+            self._prewarm_task = asyncio.create_task(self._prewarm())
+
     async def plan_trip(self, user_request: str) -> str:
         """Main method to generate a travel itinerary from a user request."""
         print("Starting workflow...")
         result = await self.app.ainvoke({"user_request": user_request})
         return result.get("final_itinerary", "No itinerary generated")
 
+    async def plan_trip_stream(self, user_request: str) -> AsyncIterator[str]:
+        """Generate a travel itinerary, yielding its text as soon as the LLM produces it."""
+        print("Starting workflow...")
+        # "messages" mode surfaces the tokens of the LLM call inside generate_itinerary_node
+        async for chunk, metadata in self.app.astream({"user_request": user_request}, stream_mode="messages"):
+            if metadata.get("langgraph_node") == "generate" and chunk.content:
+                yield chunk.content
 
-if __name__ == "__main__":
-    agent = TravelAgent(max_search_iterations=2)
+    async def aclose(self) -> None:
+        """Release the HTTP connections this event loop opened for the weather tool and the LLM."""
+        await close_http_client()
+
+
+async def main():
+    agent = TravelAgent()
 
     user_request = "I want to go to Kyoto for 5 days. i want recommendations for restaurants, bars and attractions. Also maybe a day for hiking"
-    itinerary = asyncio.run(agent.plan_trip(user_request))
+    try:
+        itinerary = await agent.plan_trip(user_request)
+    finally:
+        await agent.aclose()
 
     print("\n=== FINAL RESULT ===")
     print(itinerary)
 
+
+if __name__ == "__main__":
+    asyncio.run(main())
+
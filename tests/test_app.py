@@ -1,72 +1,347 @@
+import asyncio
+import json
 import pytest
-from unittest.mock import Mock, patch, MagicMock
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest.mock import AsyncMock, Mock, patch, MagicMock
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage
 from src.mini2.app import (
     TravelAgent,
     get_weather_forecast,
-    GraphState
+    find_points_of_interest,
+    GraphState,
+    ParsedRequest,
+    DECISION_LLM_KWARGS,
+    MAX_CONCURRENT_SEARCHES,
+    MAX_RESULT_CHARS,
+    NO_SEARCH_RESULTS,
+    _WEATHER_CACHE,
+    _SEARCH_CACHE,
+    _count_place_names,
+    _get_http_client,
+    close_http_client,
+    _get_llm,
+    _record_city,
+    _top_cities
 )
 
 
-def test_parse_request_node():
-    """Test that parse_request_node correctly extracts city, days, and interests."""
-    # Mock the LLM response
+@pytest.fixture(autouse=True)
+def isolated_cache_dir(tmp_path, monkeypatch):
+    """Keep the LLM cache and city log out of the user's home directory."""
+    monkeypatch.setattr('src.mini2.app.CACHE_DIR', tmp_path)
+    # Shared LLM clients hold a cache opened in another test's directory
+    _get_llm.cache_clear()
+    yield
+    _get_llm.cache_clear()
+
+
+class _ScriptedChatModel(GenericFakeChatModel):
+    """Fake chat model that answers the weather decision and streams everything else as an itinerary."""
+
+    async def ainvoke(self, prompt, *args, **kwargs):
+        reply = "INDOOR" if "INDOOR, OUTDOOR, or BOTH" in str(prompt) else "Day 1: Vatican Museums"
+        self.messages = iter([AIMessage(content=reply)])
+        return await super().ainvoke(prompt, *args, **kwargs)
+
+
+def _mock_http_client(api_response):
+    """Build an httpx-like client whose GET returns the given JSON payload."""
     mock_response = Mock()
-    mock_response.content = "City: Paris\nDays: 3\nInterests: museums, cafes"
+    mock_response.content = json.dumps(api_response).encode()
+    mock_response.raise_for_status = Mock()
+
+    mock_client = Mock()
+    mock_client.get = AsyncMock(return_value=mock_response)
+    return mock_client
+
+
+@pytest.mark.asyncio
+async def test_parse_request_node():
+    """Test that parse_request_node correctly extracts city, days, and interests."""
+    # Mock the structured LLM response
+    mock_response = ParsedRequest(city="Paris", days=3, interests="museums, cafes")
 
     agent = TravelAgent()
-    agent.llm = Mock()
-    agent.llm.invoke.return_value = mock_response
+    agent._parse_llm = Mock()
+    agent._parse_llm.ainvoke = AsyncMock(return_value=mock_response)
 
     state = {"user_request": "I want to go to Paris for 3 days to visit museums and cafes"}
-    result = agent.parse_request_node(state)
+    result = await agent.parse_request_node(state)
 
     assert result["city"] == "Paris"
     assert result["days"] == 3
     assert result["interests"] == "museums, cafes"
 
 
-def test_decide_activity_type_node():
+@pytest.mark.asyncio
+async def test_parse_request_node_falls_back_to_defaults():
+    """Test that a reply without a tool call or with invalid fields uses the default trip."""
+    agent = TravelAgent()
+    agent._parse_llm = Mock()
+    defaults = {"city": "Unknown", "days": 5, "interests": "sightseeing"}
+    state = {"user_request": "Somewhere nice please"}
+
+    # No tool call in the reply
+    agent._parse_llm.ainvoke = AsyncMock(return_value=None)
+    assert await agent.parse_request_node(state) == defaults
+
+    # Tool call with a non-positive number of days
+    agent._parse_llm.ainvoke = AsyncMock(side_effect=lambda prompt: ParsedRequest(city="Rome", days=0))
+    assert await agent.parse_request_node(state) == defaults
+
+
+def test_parsed_request_defaults_missing_city():
+    """Test that a tool call without a city still validates."""
+    assert ParsedRequest(days=2).city == "Unknown"
+
+
+@pytest.mark.asyncio
+async def test_decide_activity_type_node():
     """Test that decide_activity_type_node returns valid activity preference."""
     mock_response = Mock()
     mock_response.content = "INDOOR"
 
     agent = TravelAgent()
     agent.llm = Mock()
-    agent.llm.invoke.return_value = mock_response
+    agent.llm.ainvoke = AsyncMock(return_value=mock_response)
 
     state = {
         "city": "London",
         "days": 3,
         "weather_data": "Day 1: Rain, 15°C | Day 2: Rain, 14°C"
     }
-    result = agent.decide_activity_type_node(state)
+    result = await agent.decide_activity_type_node(state)
 
     assert result["activity_preference"] in ["INDOOR", "OUTDOOR", "BOTH"]
     assert result["activity_preference"] == "INDOOR"
+    assert agent.llm.ainvoke.call_args.kwargs == DECISION_LLM_KWARGS
 
 
-def test_check_activity_quality():
-    """Test that check_activity_quality returns correct routing decision."""
-    mock_response = Mock()
-    mock_response.content = "SUFFICIENT"
+@pytest.mark.asyncio
+async def test_activities_node_deduplicates_interests():
+    """Test that duplicate interests only trigger one search each."""
+    agent = TravelAgent()
+
+    mock_search = Mock()
+    mock_search.ainvoke = AsyncMock(side_effect=lambda args: f"Results for {args['category']}")
+
+    state = {"city": "Vienna", "interests": "Museums, cafes, museums , ,Cafes", "activity_preference": "BOTH"}
+    with patch('src.mini2.app.find_points_of_interest', mock_search):
+        result = await agent.activities_node(state)
+
+    assert mock_search.ainvoke.call_count == 2
+    assert result["activities"] == ["Museums: Results for museums", "Cafes: Results for cafes"]
 
+
+@pytest.mark.asyncio
+async def test_activities_node_keeps_richest_result():
+    """Test that qualified and plain searches both run and the more specific result is kept."""
     agent = TravelAgent()
-    agent.llm = Mock()
-    agent.llm.invoke.return_value = mock_response
 
-    state = {
-        "city": "Rome",
-        "activities": ["Museums: Visit the Colosseum and Vatican Museums"],
-        "search_iterations": 0
+    results = {
+        "indoor museums": "Many indoor museums are worth a visit",
+        "museums": "Visit the Kunsthistorisches Museum and the Albertina Modern gallery",
+        "indoor cafes": "Try Café Sperl or the Demel Konditorei",
+        "cafes": "Coffee culture is everywhere"
+    }
+    mock_search = Mock()
+    mock_search.ainvoke = AsyncMock(side_effect=lambda args: results[args["category"]])
+
+    state = {"city": "Vienna", "interests": "museums, cafes", "activity_preference": "INDOOR"}
+    with patch('src.mini2.app.find_points_of_interest', mock_search):
+        result = await agent.activities_node(state)
+
+    assert mock_search.ainvoke.call_count == 4
+    assert result["activities"] == [
+        "Museums: Visit the Kunsthistorisches Museum and the Albertina Modern gallery",
+        "Cafes: Try Café Sperl or the Demel Konditorei"
+    ]
+
+
+def test_count_place_names_handles_accented_names():
+    """Test that place names with accents and elided articles are counted."""
+    assert _count_place_names("Café Sperl, the Musée d'Orsay and Ölüdeniz Beach") == 3
+    assert _count_place_names("Coffee culture is everywhere") == 0
+
+
+@pytest.mark.asyncio
+async def test_activities_node_skips_failed_searches():
+    """Test that failed or empty qualified searches fall back to the plain results."""
+    agent = TravelAgent()
+
+    results = {
+        "indoor museums": "Error searching for indoor museums: 202 Ratelimit",
+        "museums": "Several museums worth visiting",
+        "indoor cafes": NO_SEARCH_RESULTS,
+        "cafes": "Coffee culture is everywhere"
     }
-    result = agent.check_activity_quality(state)
+    mock_search = Mock()
+    mock_search.ainvoke = AsyncMock(side_effect=lambda args: results[args["category"]])
+
+    state = {"city": "Vienna", "interests": "museums, cafes", "activity_preference": "INDOOR"}
+    with patch('src.mini2.app.find_points_of_interest', mock_search):
+        result = await agent.activities_node(state)
+
+    assert result["activities"] == [
+        "Museums: Several museums worth visiting",
+        "Cafes: Coffee culture is everywhere"
+    ]
+
+
+@pytest.mark.asyncio
+async def test_activities_node_compacts_results():
+    """Test that search results are whitespace-collapsed and truncated before use."""
+    agent = TravelAgent()
+
+    mock_search = Mock()
+    mock_search.ainvoke = AsyncMock(return_value="  Louvre\n\n  Museum\t" + "x" * (MAX_RESULT_CHARS * 2))
+
+    with patch('src.mini2.app.find_points_of_interest', mock_search):
+        result = await agent.activities_node({"city": "Paris", "interests": "museums"})
+
+    [activity] = result["activities"]
+    assert activity.startswith("Museums: Louvre Museum xxx")
+    assert len(activity) == len("Museums: ") + MAX_RESULT_CHARS
+
+
+@pytest.mark.asyncio
+async def test_activities_node_limits_concurrent_searches():
+    """Test that no more than MAX_CONCURRENT_SEARCHES searches run at the same time."""
+    agent = TravelAgent()
+    running = 0
+    peak = 0
+
+    async def slow_search(args):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return f"Results for {args['category']}"
+
+    mock_search = Mock()
+    mock_search.ainvoke = AsyncMock(side_effect=slow_search)
+
+    interests = ", ".join(f"interest {i}" for i in range(MAX_CONCURRENT_SEARCHES * 2))
+    with patch('src.mini2.app.find_points_of_interest', mock_search):
+        result = await agent.activities_node({"city": "Berlin", "interests": interests})
+
+    assert len(result["activities"]) == MAX_CONCURRENT_SEARCHES * 2
+    assert peak == MAX_CONCURRENT_SEARCHES
+
+
+@pytest.mark.asyncio
+async def test_find_points_of_interest_cached():
+    """Test that repeated searches for the same city and category reuse the cached results."""
+    _SEARCH_CACHE.clear()
+
+    with patch('src.mini2.app._SEARCH_TOOL') as mock_search:
+        mock_search.run.return_value = "Café Central, Café Sperl"
+
+        first = await find_points_of_interest.ainvoke({"city": "Vienna", "category": "cafes"})
+        second = await find_points_of_interest.ainvoke({"city": "vienna", "category": "Cafes "})
+
+    assert first == second == "Café Central, Café Sperl"
+    assert mock_search.run.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_find_points_of_interest_does_not_cache_empty_results():
+    """Test that an empty search is retried instead of being served from the cache."""
+    _SEARCH_CACHE.clear()
+
+    with patch('src.mini2.app._SEARCH_TOOL') as mock_search:
+        mock_search.run.side_effect = [NO_SEARCH_RESULTS, "Café Central, Café Sperl"]
+
+        first = await find_points_of_interest.ainvoke({"city": "Vienna", "category": "cafes"})
+        second = await find_points_of_interest.ainvoke({"city": "Vienna", "category": "cafes"})
+
+    assert first == NO_SEARCH_RESULTS
+    assert second == "Café Central, Café Sperl"
+    assert mock_search.run.call_count == 2
+
+
+def test_route_after_decide():
+    """Test that activities are only searched again when the weather preference changes the query."""
+    agent = TravelAgent()
 
-    assert result in ["activities", "generate"]
-    assert result == "generate"
+    state = {"city": "Rome", "activities": ["Museums: Visit the Vatican Museums"], "searched_preference": "BOTH"}
 
+    assert agent.route_after_decide({**state, "activity_preference": "BOTH"}) == "generate"
+    assert agent.route_after_decide({**state, "activity_preference": "INDOOR"}) == "activities"
 
-def test_get_weather_forecast_parsing():
+
+def test_agents_share_llm_and_build_graph_lazily():
+    """Test that agents reuse one LLM client and only compile the graph when needed."""
+    first = TravelAgent()
+    second = TravelAgent()
+
+    assert first.llm is second.llm
+    assert "app" not in vars(first)
+    assert first.app is first.app
+    assert first.app is not second.app
+
+
+def test_max_search_iterations_is_deprecated():
+    """Test that the retired search-loop setting is still accepted but warns."""
+    with pytest.warns(DeprecationWarning, match="max_search_iterations"):
+        TravelAgent(max_search_iterations=2)
+
+
+def test_http_client_outlives_agent_close_and_event_loop():
+    """Test that closing one agent or ending an event loop leaves the shared client usable."""
+    first = TravelAgent()
+    second = TravelAgent()
+
+    async def loop_client_then_close():
+        client = second.llm.http_async_client.loop_client()
+        await first.aclose()
+        return client
+
+    # Each asyncio.run gets fresh connections instead of ones bound to the previous loop
+    assert asyncio.run(loop_client_then_close()) is not asyncio.run(loop_client_then_close())
+    assert not second.llm.http_async_client.is_closed
+
+
+@pytest.mark.asyncio
+async def test_http_client_respects_proxy_env(monkeypatch):
+    """Test that the shared client sends through the proxy named in the environment."""
+    seen = []
+
+    class ProxyHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            seen.append(self.path)
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    proxy = HTTPServer(("127.0.0.1", 0), ProxyHandler)
+    threading.Thread(target=proxy.serve_forever, daemon=True).start()
+    for name in ["HTTP_PROXY", "http_proxy"]:
+        monkeypatch.setenv(name, f"http://127.0.0.1:{proxy.server_port}")
+    for name in ["NO_PROXY", "no_proxy", "ALL_PROXY", "all_proxy"]:
+        monkeypatch.delenv(name, raising=False)
+
+    try:
+        response = await _get_http_client().get("http://api.openweathermap.org/data/2.5/forecast")
+        await close_http_client()
+    finally:
+        proxy.shutdown()
+
+    assert response.status_code == 200
+    assert seen == ["http://api.openweathermap.org/data/2.5/forecast"]
+
+
+@pytest.mark.asyncio
+async def test_get_weather_forecast_parsing():
     """Test that get_weather_forecast correctly parses API data."""
+    _WEATHER_CACHE.clear()
+
     # Mock API response - API returns 3-hour forecasts, so 8 items per day
     # We need items at indices 0, 8, 16 for days 1, 2, 3
     mock_list = [None] * 24  # Create enough items
@@ -81,16 +356,128 @@ def test_get_weather_forecast_parsing():
 
     mock_api_response = {'list': mock_list}
 
-    mock_response = Mock()
-    mock_response.json.return_value = mock_api_response
-    mock_response.raise_for_status = Mock()
-
-    with patch('src.mini2.app.requests.get') as mock_get, \
+    with patch('src.mini2.app._get_http_client', return_value=_mock_http_client(mock_api_response)), \
          patch.dict('os.environ', {'OPENWEATHERMAP_API_KEY': 'test_key'}):
-        mock_get.return_value = mock_response
-
-        result = get_weather_forecast.invoke({"city": "Athens", "days": 3})
+        result = await get_weather_forecast.ainvoke({"city": "Athens", "days": 3})
 
         assert "Day 1: Clear, 25.5°C" in result
         assert "Day 2: Rain, 18.2°C" in result
         assert "Day 3: Clouds, 22.0°C" in result
+
+
+@pytest.mark.asyncio
+async def test_get_weather_forecast_cached():
+    """Test that repeated forecasts for the same city reuse the cached API response."""
+    _WEATHER_CACHE.clear()
+
+    mock_list = [{'weather': [{'main': 'Snow'}], 'main': {'temp': -2.0}}] * 40
+
+    mock_client = _mock_http_client({'list': mock_list})
+
+    with patch('src.mini2.app._get_http_client', return_value=mock_client), \
+         patch.dict('os.environ', {'OPENWEATHERMAP_API_KEY': 'test_key'}):
+        first = await get_weather_forecast.ainvoke({"city": "Oslo", "days": 2})
+        second = await get_weather_forecast.ainvoke({"city": " oslo ", "days": 4})
+
+        assert mock_client.get.call_count == 1
+        assert first == "Day 1: Snow, -2.0°C | Day 2: Snow, -2.0°C"
+        assert "Day 4: Snow, -2.0°C" in second
+
+
+def test_city_log_ranks_by_count():
+    """Test that the city log returns the most frequently planned cities first."""
+    for city in ["Paris", "Rome", " paris", "Kyoto", "Rome", "PARIS"]:
+        _record_city(city)
+
+    assert _top_cities(2) == ["paris", "rome"]
+    assert _top_cities(10) == ["paris", "rome", "kyoto"]
+
+
+@pytest.mark.asyncio
+async def test_weather_node_skips_cities_without_forecast():
+    """Test that only cities with a forecast are added to the city log."""
+    agent = TravelAgent()
+
+    mock_weather = Mock()
+    mock_weather.ainvoke = AsyncMock(side_effect=["Error fetching weather: 404 Not Found", "Day 1: Clear, 20.0°C"])
+
+    with patch('src.mini2.app.get_weather_forecast', mock_weather):
+        await agent.weather_node({"city": "Parsi", "days": 3})
+        await agent.weather_node({"city": "Paris", "days": 3})
+
+    assert _top_cities(10) == ["paris"]
+
+
+@pytest.mark.asyncio
+async def test_prewarm_fetches_top_cities():
+    """Test that prewarming requests forecasts for the logged cities."""
+    _WEATHER_CACHE.clear()
+    agent = TravelAgent()
+
+    mock_weather = Mock()
+    mock_weather.ainvoke = AsyncMock(return_value="Day 1: Clear, 20.0°C")
+
+    with patch('src.mini2.app._top_cities', return_value=["paris", "rome"]), \
+         patch('src.mini2.app.get_weather_forecast', mock_weather):
+        await agent._prewarm()
+
+    fetched = [call.args[0]["city"] for call in mock_weather.ainvoke.call_args_list]
+    assert fetched == ["paris", "rome"]
+
+
+@pytest.mark.asyncio
+async def test_weather_node_waits_for_prewarm_of_same_city():
+    """Test that a trip to a city being prewarmed reuses that fetch instead of requesting it again."""
+    _WEATHER_CACHE.clear()
+    agent = TravelAgent()
+
+    mock_client = _mock_http_client({'list': [{'weather': [{'main': 'Clear'}], 'main': {'temp': 20.0}}] * 40})
+    response = mock_client.get.return_value
+
+    async def slow_get(url):
+        await asyncio.sleep(0.05)
+        return response
+
+    mock_client.get.side_effect = slow_get
+
+    with patch('src.mini2.app._top_cities', return_value=["rome"]), \
+         patch('src.mini2.app._get_http_client', return_value=mock_client), \
+         patch.dict('os.environ', {'OPENWEATHERMAP_API_KEY': 'test_key'}):
+        agent.start_prewarm()
+        while "rome" not in agent._forecast_fetches:
+            await asyncio.sleep(0)
+        result = await agent.weather_node({"city": "Rome", "days": 1})
+        await agent._prewarm_task
+
+    assert mock_client.get.call_count == 1
+    assert result["weather_data"] == "Day 1: Clear, 20.0°C"
+
+
+def test_plan_trip_does_not_prewarm():
+    """Test that a single trip does not fetch forecasts it will never use."""
+    agent = TravelAgent()
+    agent.app.ainvoke = AsyncMock(return_value={"final_itinerary": "Day 1"})
+
+    assert asyncio.run(agent.plan_trip("Rome")) == "Day 1"
+    assert agent._prewarm_task is None
+
+
+@pytest.mark.asyncio
+async def test_plan_trip_stream_yields_only_itinerary_tokens():
+    """Test that streaming yields the generate node's tokens and filters out the other LLM calls."""
+    agent = TravelAgent()
+    agent.llm = _ScriptedChatModel(messages=iter([]))
+    agent._parse_llm = Mock()
+    agent._parse_llm.ainvoke = AsyncMock(return_value=ParsedRequest(city="Rome", days=1, interests="museums"))
+
+    mock_weather = Mock()
+    mock_weather.ainvoke = AsyncMock(return_value="Day 1: Rain, 10.0°C")
+    mock_search = Mock()
+    mock_search.ainvoke = AsyncMock(return_value="Visit the Vatican Museums")
+
+    with patch('src.mini2.app.get_weather_forecast', mock_weather), \
+         patch('src.mini2.app.find_points_of_interest', mock_search):
+        tokens = [token async for token in agent.plan_trip_stream("Rome for a day, museums")]
+
+    assert len(tokens) > 1
+    assert "".join(tokens) == "Day 1: Vatican Museums"